@@ -1,9 +1,12 @@
 import chromadb
+import lexical_index
+import config
 import os
+import shutil
 import time
 from datetime import datetime, timedelta
 
-DB_PATH = "./chroma_db"
+DB_PATH = config.DB_PATH
 EXPIRATION_HOURS = 24
 
 def cleanup_old_collections():
@@ -37,6 +40,8 @@ def cleanup_old_collections():
                     if file_mod_time < expiration_limit:
                         print(f"Deleting old collection: {collection.name} (Last modified: {datetime.fromtimestamp(file_mod_time)})")
                         client.delete_collection(name=collection.name)
+                        lexical_index.delete(collection.name)
+                        shutil.rmtree(os.path.join(config.IMAGE_DIR, collection.name), ignore_errors=True)
                         deleted_count += 1
                 else:
                     print(f"Warning: Could not find DB file for collection '{collection.name}'. Skipping.")
@@ -0,0 +1,10 @@
+# Settings shared by the server and the standalone scripts (cleanup.py, snapshot.py). Kept free of
+# heavy imports so those scripts don't load torch and the models just to find the data directories.
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB_PATH = "./chroma_db"
+IMAGE_DIR = os.environ.get("IMAGE_DIR", "/tmp/extracted_images")
+EMBEDDING_MODEL = 'clip-ViT-B-32'
@@ -0,0 +1,50 @@
+# Multi-worker mode: gunicorn -c gunicorn.conf.py main:app
+#
+# The app is imported and the CLIP model loaded once in the master process, then
+# the HTTP and ingestion workers are forked from it and share the weights
+# copy-on-write instead of each loading their own copy.
+import os
+import gc
+import threading
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '7860')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = 120
+
+
+def _torch_threads():
+    if "TORCH_THREADS" in os.environ:
+        return int(os.environ["TORCH_THREADS"])
+    import ingest_queue
+    return max(1, (os.cpu_count() or 1) // (workers + ingest_queue.INGEST_WORKERS))
+
+
+def on_starting(server):
+    import rag_logic
+    import ingest_queue
+
+    rag_logic.load_embedding_model()
+    # Keep the garbage collector from touching (and so copying) the preloaded objects in
+    # every forked process, the ingestion consumers included.
+    gc.freeze()
+    ingest_queue.start(ingest_queue.INGEST_WORKERS, _torch_threads())
+
+
+def when_ready(server):
+    import ingest_queue
+    threading.Thread(target=ingest_queue.supervise, name="ingest-supervisor", daemon=True).start()
+
+
+def post_fork(server, worker):
+    import rag_logic
+    import llm_client
+    rag_logic.configure_torch_threads(_torch_threads())
+    # Every worker gets its own Groq client, so split the configured rate between them.
+    llm_client.share_rate_limit(workers)
+
+
+def on_exit(server):
+    import ingest_queue
+    ingest_queue.stop()
@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import signal
+import asyncio
+import threading
+import traceback
+import rag_logic
+import scheduler
+
+JOB_DIR = os.environ.get("INGEST_JOB_DIR", "/tmp/ingest_jobs")
+CONSUMER_DIR = os.path.join(JOB_DIR, "consumers")
+QUEUE_DIR = os.path.join(JOB_DIR, "queue")
+CLAIM_DIR = os.path.join(JOB_DIR, "claims")
+STOP_PATH = os.path.join(JOB_DIR, "stop")
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "1"))
+INGEST_TIMEOUT_SECONDS = float(os.environ.get("INGEST_TIMEOUT_SECONDS", "900"))
+POLL_INTERVAL_SECONDS = 0.25
+SUPERVISE_INTERVAL_SECONDS = 5.0
+# How long a job may wait with no live consumer before it fails (covers a respawn by the supervisor).
+NO_CONSUMER_GRACE_SECONDS = 3 * SUPERVISE_INTERVAL_SECONDS
+
+# Signals gunicorn's master handles itself; a consumer forked from it must go back to the defaults.
+MASTER_SIGNALS = (signal.SIGHUP, signal.SIGQUIT, signal.SIGINT, signal.SIGTERM, signal.SIGTTIN,
+                  signal.SIGTTOU, signal.SIGUSR1, signal.SIGUSR2, signal.SIGWINCH, signal.SIGCHLD)
+
+# Jobs are plain files so that no lock is shared between processes: a consumer that is killed
+# at any point can't leave the queue stuck for the others.
+#   queue/<job_id>.json        submitted, waiting for a consumer
+#   claims/<job_id>.<pid>      taken by consumer <pid> (an atomic rename of the queue file)
+#   <job_id>.json              result, written by the consumer
+#   <job_id>.abandoned         the waiter gave up; the consumer skips or discards the job
+
+# Only set in the gunicorn master (see gunicorn.conf.py) and inherited by every forked worker.
+# When it is 0 the server is running as a single process and ingestion runs inline.
+_torch_threads = 1
+_num_workers = 0
+_stopping = threading.Event()
+
+
+def is_running():
+    return _num_workers > 0
+
+
+def _queue_path(job_id: str):
+    return os.path.join(QUEUE_DIR, f"{job_id}.json")
+
+
+def _result_path(job_id: str):
+    return os.path.join(JOB_DIR, f"{job_id}.json")
+
+
+def _claim_path(job_id: str, pid: int):
+    return os.path.join(CLAIM_DIR, f"{job_id}.{pid}")
+
+
+def _abandoned_path(job_id: str):
+    return os.path.join(JOB_DIR, f"{job_id}.abandoned")
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _pid_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _clear_dir(path: str):
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        _remove_quietly(os.path.join(path, name))
+
+
+def _live_consumers():
+    # Consumers are registered as empty files named after their pid, so HTTP workers
+    # (which are not their parents) can see them too.
+    live = []
+    for name in os.listdir(CONSUMER_DIR):
+        if _pid_alive(int(name)):
+            live.append(int(name))
+        else:
+            _remove_quietly(os.path.join(CONSUMER_DIR, name))
+    return live
+
+
+def _write_result(job_id: str, result: dict):
+    # Written to a temp file and renamed so a polling worker never reads a half-written result.
+    tmp_path = _result_path(job_id) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(result, f)
+    os.replace(tmp_path, _result_path(job_id))
+    # The waiter gave up on this job, so nobody will ever read the result.
+    if os.path.exists(_abandoned_path(job_id)):
+        _remove_quietly(_result_path(job_id))
+        _remove_quietly(_abandoned_path(job_id))
+
+
+def _queued_jobs():
+    # Oldest first, so jobs are picked up in the order they were submitted.
+    jobs = []
+    for entry in os.scandir(QUEUE_DIR):
+        try:
+            jobs.append((entry.stat().st_mtime_ns, entry.name))
+        except FileNotFoundError:
+            continue  # claimed by another consumer in the meantime
+    return [name[:-len(".json")] for _, name in sorted(jobs)]
+
+
+def _claim_next_job():
+    # os.rename is atomic, so exactly one consumer wins each job.
+    for job_id in _queued_jobs():
+        claim_path = _claim_path(job_id, os.getpid())
+        try:
+            os.rename(_queue_path(job_id), claim_path)
+        except FileNotFoundError:
+            continue
+        with open(claim_path) as f:
+            job = json.load(f)
+        return job_id, job["session_id"], job["pdf_path"]
+    return None
+
+
+def _consume(torch_threads: int):
+    # Ingestion runs at a lower OS priority and with its own torch thread budget so queries stay fast.
+    if scheduler.INGEST_NICE:
+        os.nice(scheduler.INGEST_NICE)
+    rag_logic.configure_torch_threads(scheduler.INGEST_TORCH_THREADS or torch_threads)
+    while not os.path.exists(STOP_PATH):
+        job = _claim_next_job()
+        if job is None:
+            time.sleep(POLL_INTERVAL_SECONDS)
+            continue
+        job_id, session_id, pdf_path = job
+        try:
+            if os.path.exists(_abandoned_path(job_id)):
+                # Nobody is waiting for this job any more, so don't build a session nobody will use.
+                _remove_quietly(_abandoned_path(job_id))
+                continue
+            print(f"Ingestion worker {os.getpid()} picked up session {session_id}")
+            try:
+                item_count = rag_logic.ingest_document(session_id, pdf_path)
+                _write_result(job_id, {"item_count": item_count})
+            except Exception as e:
+                _write_result(job_id, {"error": str(e)})
+        finally:
+            _remove_quietly(_claim_path(job_id, os.getpid()))
+            _remove_quietly(pdf_path)
+
+
+def _spawn_consumer():
+    # A bare os.fork rather than multiprocessing.Process: the HTTP workers inherit multiprocessing's
+    # child registry from the master, and its atexit hook would terminate (daemonic) or try to join
+    # (non-daemonic) every consumer whenever one of those workers exits.
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            for sig in MASTER_SIGNALS:
+                signal.signal(sig, signal.SIG_DFL)
+            _consume(_torch_threads)
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+    # Registered by the parent so the supervisor never sees a just-forked consumer as missing.
+    open(os.path.join(CONSUMER_DIR, str(pid)), "w").close()
+    return pid
+
+
+def start(num_workers: int, torch_threads: int):
+    # Must be called in the parent after the model is loaded, so consumers share its weights.
+    global _torch_threads, _num_workers
+    # Anything left over belongs to a previous server whose waiters are gone.
+    for path in (CONSUMER_DIR, QUEUE_DIR, CLAIM_DIR):
+        _clear_dir(path)
+    _remove_quietly(STOP_PATH)
+    _torch_threads = torch_threads
+    _num_workers = num_workers
+    for _ in range(num_workers):
+        _spawn_consumer()
+    print(f"Started {num_workers} ingestion worker(s).")
+
+
+def supervise():
+    # Runs on a thread in the gunicorn master and replaces consumers that have died (OOM kill, crash, ...).
+    while not _stopping.wait(SUPERVISE_INTERVAL_SECONDS):
+        missing = _num_workers - len(_live_consumers())
+        for _ in range(missing):
+            pid = _spawn_consumer()
+            print(f"Ingestion worker missing, started replacement (pid {pid}).")
+
+
+def stop():
+    _stopping.set()
+    # Consumers exit once they see the stop file, after finishing the job they are on.
+    open(STOP_PATH, "w").close()
+    live = _live_consumers()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and any(_pid_alive(pid) for pid in live):
+        time.sleep(POLL_INTERVAL_SECONDS)
+    for pid in live:
+        if _pid_alive(pid):
+            os.kill(pid, signal.SIGTERM)
+
+
+def submit(job_id: str, session_id: str, pdf_path: str):
+    # The consumer owns pdf_path from here on and deletes it when it is done. The job file is
+    # written next to the queue and renamed in, so a consumer never reads a half-written one.
+    tmp_path = os.path.join(JOB_DIR, f"{job_id}.job.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"session_id": session_id, "pdf_path": pdf_path}, f)
+    os.replace(tmp_path, _queue_path(job_id))
+
+
+def _abandon(job_id: str, pdf_path: str):
+    # A job still in the queue is simply withdrawn.
+    try:
+        os.remove(_queue_path(job_id))
+        _remove_quietly(pdf_path)
+        return
+    except FileNotFoundError:
+        pass
+    # Otherwise mark it so the consumer skips it or throws its result away, and cover
+    # the case where the result landed between our last check and the mark.
+    open(_abandoned_path(job_id), "w").close()
+    if os.path.exists(_result_path(job_id)):
+        _remove_quietly(_result_path(job_id))
+        _remove_quietly(_abandoned_path(job_id))
+
+
+def _read_claim(job_id: str):
+    # Returns the pid of the consumer that claimed the job, or None if it hasn't been claimed.
+    prefix = f"{job_id}."
+    for name in os.listdir(CLAIM_DIR):
+        if name.startswith(prefix):
+            return int(name[len(prefix):])
+    return None
+
+
+async def wait_for_result(job_id: str, pdf_path: str):
+    deadline = time.monotonic() + INGEST_TIMEOUT_SECONDS
+    no_consumer_since = None
+    path = _result_path(job_id)
+    while not os.path.exists(path):
+        claimed_by = _read_claim(job_id)
+        if claimed_by is not None and not _pid_alive(claimed_by) and not os.path.exists(path):
+            _remove_quietly(_claim_path(job_id, claimed_by))
+            _remove_quietly(pdf_path)
+            raise RuntimeError("The ingestion worker stopped while processing this document.")
+
+        if claimed_by is None and not _live_consumers():
+            no_consumer_since = no_consumer_since or time.monotonic()
+            if time.monotonic() - no_consumer_since > NO_CONSUMER_GRACE_SECONDS:
+                _abandon(job_id, pdf_path)
+                raise RuntimeError("No ingestion worker is running. Please try again shortly.")
+        else:
+            no_consumer_since = None
+
+        if time.monotonic() > deadline:
+            _abandon(job_id, pdf_path)
+            raise TimeoutError(f"Ingestion job {job_id} did not finish within {INGEST_TIMEOUT_SECONDS:.0f} seconds.")
+        await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+    with open(path) as f:
+        result = json.load(f)
+    _remove_quietly(path)
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result["item_count"]
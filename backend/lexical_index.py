@@ -0,0 +1,123 @@
+import os
+import re
+import json
+import math
+import threading
+from collections import Counter, OrderedDict
+
+INDEX_DIR = os.environ.get("LEXICAL_INDEX_DIR", "./lexical_index")
+CACHE_SIZE = int(os.environ.get("LEXICAL_INDEX_CACHE_SIZE", "32"))
+RRF_K = 60
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Keeps numbers like "3.14" and hyphenated names like "ViT-B" together as single terms.
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def tokenize(text: str):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    def __init__(self, ids, doc_lengths, postings, pages):
+        self.ids = ids
+        self.doc_lengths = doc_lengths
+        self.pages = pages
+        # term -> [[doc position, term frequency], ...]
+        self.postings = postings
+        self.avg_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0
+
+    @classmethod
+    def build(cls, ids, documents, pages):
+        doc_lengths, postings = [], {}
+        for position, document in enumerate(documents):
+            terms = tokenize(document)
+            doc_lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                postings.setdefault(term, []).append([position, tf])
+        return cls(list(ids), doc_lengths, postings, list(pages))
+
+    def search(self, query: str, k: int, pages=None):
+        n = len(self.ids)
+        allowed = set(pages) if pages else None
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, tf in postings:
+                if allowed is not None and self.pages[position] not in allowed:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[position] / self.avg_length)
+                scores[position] = scores.get(position, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.ids[position], score) for position, score in ranked]
+
+    def to_dict(self):
+        return {"ids": self.ids, "doc_lengths": self.doc_lengths, "postings": self.postings, "pages": self.pages}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["ids"], data["doc_lengths"], data["postings"], data.get("pages", [None] * len(data["ids"])))
+
+
+def _index_path(session_id: str):
+    return os.path.join(INDEX_DIR, f"{session_id}.json")
+
+
+def _remember(session_id: str, index: BM25Index):
+    with _cache_lock:
+        _cache[session_id] = index
+        _cache.move_to_end(session_id)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def build_and_save(session_id: str, ids, documents, pages):
+    return save(session_id, BM25Index.build(ids, documents, pages))
+
+
+def save(session_id: str, index: BM25Index):
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    tmp_path = _index_path(session_id) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index.to_dict(), f)
+    os.replace(tmp_path, _index_path(session_id))
+    _remember(session_id, index)
+    return index
+
+
+def load(session_id: str):
+    with _cache_lock:
+        if session_id in _cache:
+            _cache.move_to_end(session_id)
+            return _cache[session_id]
+    path = _index_path(session_id)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        index = BM25Index.from_dict(json.load(f))
+    _remember(session_id, index)
+    return index
+
+
+def delete(session_id: str):
+    with _cache_lock:
+        _cache.pop(session_id, None)
+    if os.path.exists(_index_path(session_id)):
+        os.remove(_index_path(session_id))
+
+
+def reciprocal_rank_fusion(rankings, k: int = RRF_K):
+    # Each ranking is a list of ids, best first. Ids ranked highly by several lists rise to the top.
+    scores = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
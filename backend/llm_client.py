@@ -0,0 +1,180 @@
+import os
+import time
+import json
+import random
+import hashlib
+import threading
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
+
+import httpx
+import groq
+from groq import Groq
+
+# GROQ_BASE_URL can point the client at a local fake endpoint for testing.
+GROQ_BASE_URL = os.environ.get("GROQ_BASE_URL")
+GROQ_MAX_CONNECTIONS = int(os.environ.get("GROQ_MAX_CONNECTIONS", "20"))
+GROQ_MAX_KEEPALIVE = int(os.environ.get("GROQ_MAX_KEEPALIVE", "10"))
+GROQ_TIMEOUT_SECONDS = float(os.environ.get("GROQ_TIMEOUT_SECONDS", "60"))
+GROQ_MAX_RETRIES = int(os.environ.get("GROQ_MAX_RETRIES", "4"))
+GROQ_CALL_DEADLINE_SECONDS = float(os.environ.get("GROQ_CALL_DEADLINE_SECONDS", "90"))
+GROQ_REQUESTS_PER_SECOND = float(os.environ.get("GROQ_REQUESTS_PER_SECOND", "0.5"))  # 0 = unlimited
+GROQ_BURST = int(os.environ.get("GROQ_BURST", "5"))
+
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 20.0
+
+RETRYABLE_ERRORS = (groq.RateLimitError, groq.InternalServerError, groq.APITimeoutError, groq.APIConnectionError)
+
+
+class CallDeadlineExceeded(TimeoutError):
+    pass
+
+
+class TokenBucket:
+    # Thread-safe token bucket shared by every VLM and LLM call in the process. A rate of 0 disables it.
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if now < self._paused_until:
+            self._updated = now
+            return
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, deadline: float):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            if now + wait > deadline:
+                raise CallDeadlineExceeded("Timed out waiting for the Groq rate limiter.")
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        # Called when the provider tells us to back off, so other callers wait as well.
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+def _retry_after_seconds(error: Exception):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff_seconds(attempt: int):
+    # "Full jitter" exponential backoff.
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class ResilientGroqClient:
+    def __init__(self, api_key: str, base_url: str = None):
+        http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=GROQ_MAX_CONNECTIONS,
+                max_keepalive_connections=GROQ_MAX_KEEPALIVE,
+                keepalive_expiry=30,
+            ),
+            timeout=httpx.Timeout(GROQ_TIMEOUT_SECONDS, connect=5.0),
+        )
+        # Retries are handled here rather than by the SDK so they share the rate limiter.
+        self._client = Groq(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+        self._limiter = TokenBucket(GROQ_REQUESTS_PER_SECOND, GROQ_BURST)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def _create_with_retries(self, timeout: float, max_retries: int, deadline_seconds: float, **kwargs):
+        # deadline_seconds bounds the whole call, including rate-limit waits, retries and backoff.
+        deadline = time.monotonic() + deadline_seconds
+        for attempt in range(max_retries + 1):
+            self._limiter.acquire(deadline)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise CallDeadlineExceeded(f"Groq call did not finish within {deadline_seconds:.0f} seconds.")
+            try:
+                return self._client.chat.completions.create(timeout=min(timeout, remaining), **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                retry_after = _retry_after_seconds(e)
+                if retry_after is not None:
+                    self._limiter.pause(retry_after)
+                    delay = retry_after + random.uniform(0, BACKOFF_BASE_SECONDS)
+                else:
+                    delay = _backoff_seconds(attempt)
+                if time.monotonic() + delay >= deadline:
+                    raise
+                print(f"Groq call failed ({type(e).__name__}), retrying in {delay:.1f}s (attempt {attempt + 1}/{max_retries})")
+                time.sleep(delay)
+
+    def complete(self, timeout: float = GROQ_TIMEOUT_SECONDS, max_retries: int = GROQ_MAX_RETRIES, deadline_seconds: float = GROQ_CALL_DEADLINE_SECONDS, **kwargs):
+        # Identical requests already in flight share a single upstream call.
+        key = hashlib.sha256(json.dumps(kwargs, sort_keys=True, default=str).encode()).hexdigest()
+        with self._inflight_lock:
+            pending = self._inflight.get(key)
+            if pending is None:
+                pending = self._inflight[key] = Future()
+                is_leader = True
+            else:
+                is_leader = False
+
+        if not is_leader:
+            return pending.result()
+
+        try:
+            result = self._create_with_retries(timeout, max_retries, deadline_seconds, **kwargs)
+            pending.set_result(result)
+            return result
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def stream(self, timeout: float = GROQ_TIMEOUT_SECONDS, max_retries: int = GROQ_MAX_RETRIES, deadline_seconds: float = GROQ_CALL_DEADLINE_SECONDS, **kwargs):
+        # Retries only cover opening the stream; once chunks are flowing they are passed straight through.
+        return self._create_with_retries(timeout, max_retries, deadline_seconds, stream=True, **kwargs)
+
+
+def share_rate_limit(num_processes: int):
+    # GROQ_REQUESTS_PER_SECOND and GROQ_BURST are for the whole server. When several worker
+    # processes each build a client, each one gets an equal share. Call before create_client().
+    global GROQ_REQUESTS_PER_SECOND, GROQ_BURST
+    GROQ_REQUESTS_PER_SECOND /= num_processes
+    GROQ_BURST = max(1, GROQ_BURST // num_processes)
+
+
+def create_client():
+    return ResilientGroqClient(api_key=os.environ.get("GROQ_API_KEY"), base_url=GROQ_BASE_URL)
@@ -1,13 +1,20 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from starlette.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from starlette.responses import StreamingResponse, FileResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 from contextlib import asynccontextmanager
 import os
 import shutil
 import rag_logic
+import ingest_queue
+import snapshot
+import uploads
 import uuid
+import tempfile
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -17,6 +24,9 @@ async def lifespan(app: FastAPI):
 
 app = FastAPI(lifespan=lifespan)
 
+# Registered before CORSMiddleware so the 413 still carries CORS headers.
+app.add_middleware(uploads.UploadSizeLimitMiddleware)
+
 origins = [
     "http://localhost:5173",  # For local development
     "https://vecto-read.vercel.app/", 
@@ -33,6 +43,7 @@ app.add_middleware(
 class QueryRequest(BaseModel):
     query: str
     session_id: str
+    pages: Optional[List[int]] = Field(None, description="Restrict retrieval to these pages. Page numbers are 0-based (the first page is 0).")
 
 class IngestResponse(BaseModel):
     message: str
@@ -44,31 +55,23 @@ class IngestResponse(BaseModel):
 def read_root():
     return {"status": "Multimodal RAG API is running"}
 
-@app.post("/ingest", response_model=IngestResponse)
-async def ingest_pdf(file: UploadFile = File(...)):
-    if file.content_type != 'application/pdf':
-        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a PDF.")
+@app.post("/ingest", response_model=IngestResponse, openapi_extra=uploads.UPLOAD_OPENAPI)
+async def ingest_pdf(request: Request):
+    file = await uploads.spool_upload(request, required_content_type='application/pdf')
+    upload_path = file.path
 
     try:
         session_id = str(uuid.uuid4())
-        print(f"New session started: {session_id}")
-
-        file_content = await file.read()
-        
-        text, images, tables = rag_logic.extract_content_from_pdf(file_content)
-        
-        text_splitter = rag_logic.RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-        text_chunks = text_splitter.split_text(text)
-        
-        print("Generating embeddings...")
-        text_emb, img_emb, tbl_emb = rag_logic.generate_embeddings(text_chunks, images, tables, rag_logic.embedding_model)
-        
-        print("Storing in ChromaDB...")
-        item_count = rag_logic.store_in_chromadb(
-            session_id, text_chunks, text_emb, images, img_emb, tables, tbl_emb
-        )
-        
-        rag_logic.load_query_models()
+        print(f"New session started: {session_id} (sha256: {file.sha256})")
+
+        if ingest_queue.is_running():
+            # Hand the job to the shared ingestion workers instead of doing it in this HTTP worker.
+            job_id = str(uuid.uuid4())
+            job_path, upload_path = upload_path, None
+            ingest_queue.submit(job_id, session_id, job_path)
+            item_count = await ingest_queue.wait_for_result(job_id, job_path)
+        else:
+            item_count = await run_in_threadpool(rag_logic.ingest_document, session_id, upload_path)
 
         return IngestResponse(
             message=f"Successfully ingested '{file.filename}'", 
@@ -78,15 +81,58 @@ async def ingest_pdf(file: UploadFile = File(...)):
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred during ingestion: {str(e)}")
+    finally:
+        if upload_path is not None:
+            os.remove(upload_path)
 
 
 @app.post("/query")
 async def handle_query(request: QueryRequest):
     return StreamingResponse(
-        rag_logic.process_query_and_generate(request.query, request.session_id), 
+        rag_logic.process_query_and_generate(request.query, request.session_id, request.pages), 
         media_type="text/event-stream"
     )
 
 
+@app.get("/sessions/{session_id}/snapshot")
+async def export_snapshot(session_id: str):
+    os.makedirs(uploads.UPLOAD_DIR, exist_ok=True)
+    fd, bundle_path = tempfile.mkstemp(suffix=".tar.gz", dir=uploads.UPLOAD_DIR)
+    os.close(fd)
+    try:
+        await run_in_threadpool(snapshot.export_session, session_id, bundle_path)
+    except snapshot.SessionNotFoundError as e:
+        os.remove(bundle_path)
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        os.remove(bundle_path)
+        raise HTTPException(status_code=500, detail=f"An error occurred during snapshot export: {str(e)}")
+
+    return FileResponse(
+        bundle_path,
+        media_type="application/gzip",
+        filename=f"{session_id}.tar.gz",
+        background=BackgroundTask(os.remove, bundle_path)
+    )
+
+
+@app.post("/sessions/import", response_model=IngestResponse, openapi_extra=uploads.UPLOAD_OPENAPI)
+async def import_snapshot(request: Request):
+    file = await uploads.spool_upload(request)
+
+    try:
+        print(f"Importing snapshot '{file.filename}' (sha256: {file.sha256})")
+        session_id, item_count = await run_in_threadpool(snapshot.import_bundle, file.path)
+        return IngestResponse(
+            message=f"Successfully imported '{file.filename}'",
+            item_count=item_count,
+            session_id=session_id
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred during snapshot import: {str(e)}")
+    finally:
+        os.remove(file.path)
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
@@ -3,29 +3,45 @@ from sentence_transformers import SentenceTransformer
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import chromadb
 import numpy as np
+import torch
 from PIL import Image
 import io
 import os
 import html
 import base64
 from dotenv import load_dotenv
-from groq import Groq
+import groq
+import llm_client
+import lexical_index
+import scheduler
+from config import DB_PATH, IMAGE_DIR, EMBEDDING_MODEL
 
 load_dotenv()
 
 
+RETRIEVAL_CANDIDATES = int(os.environ.get("RETRIEVAL_CANDIDATES", "20"))
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "6"))
+# Image descriptions run one after another inside a query, so each gets a much tighter budget than the answer.
+VLM_TIMEOUT_SECONDS = float(os.environ.get("VLM_TIMEOUT_SECONDS", "20"))
+VLM_MAX_RETRIES = int(os.environ.get("VLM_MAX_RETRIES", "1"))
+VLM_DEADLINE_SECONDS = float(os.environ.get("VLM_DEADLINE_SECONDS", "30"))
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 50
+
 embedding_model = None
 collection = None
 groq_client = None
 
 
-def extract_content_from_pdf(file_content: bytes):
-    doc = fitz.open(stream=file_content, filetype="pdf")
+def extract_content_from_pdf(pdf_path: str):
+    # Opening from a path lets PyMuPDF read pages lazily instead of holding the whole file in memory.
+    doc = fitz.open(pdf_path, filetype="pdf")
     
-    text, images, tables = "", [], []
+    pages, images, tables = [], [], []
     for page_num in range(len(doc)):
+        scheduler.yield_to_queries()
         page = doc.load_page(page_num)
-        text += page.get_text()
+        pages.append((page.get_text(), page_num))
         for img_index, img in enumerate(page.get_images(full=True)):
             xref = img[0]
             base_image = doc.extract_image(xref)
@@ -33,45 +49,73 @@ def extract_content_from_pdf(file_content: bytes):
             images.append((image, page_num))
         for table in page.find_tables():
             tables.append((table.to_markdown(clean=True), page_num))
-    return text, images, tables
+    doc.close()
+    return pages, images, tables
+
+def _split_page(page):
+    page_text, page_num = page
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, add_start_index=True)
+    return [(chunk.page_content, page_num, chunk.metadata['start_index']) for chunk in text_splitter.create_documents([page_text])]
+
+def chunk_pages(pages):
+    # Splits each page on its own so chunks never cross a page boundary and keep their page and offset.
+    # Pages are small, so this stays in-process; a process pool costs more in fork and pickling than it saves.
+    return [chunk for page in pages for chunk in _split_page(page)]
+
+def _encode_in_batches(model, items, kind: str):
+    # Small, memory-sized batches with a pause between them, so queries on this node get the CPU first.
+    if not items:
+        return np.array([])
+    batch_size = scheduler.embedding_batch_size(kind)
+    batches = []
+    for start in range(0, len(items), batch_size):
+        scheduler.yield_to_queries()
+        batches.append(model.encode(items[start:start + batch_size], batch_size=batch_size))
+    return np.concatenate(batches)
 
 def generate_embeddings(text_chunks, images, tables, model):
-    text_embeddings = model.encode(text_chunks)
+    text_embeddings = _encode_in_batches(model, [chunk for chunk, _, _ in text_chunks], "text")
     image_objects = [img.convert("RGB") for img, _ in images]
-    image_embeddings = model.encode(image_objects) if image_objects else np.array([])
+    image_embeddings = _encode_in_batches(model, image_objects, "image")
     table_markdowns = [tbl for tbl, _ in tables]
-    table_embeddings = model.encode(table_markdowns) if table_markdowns else np.array([])
+    table_embeddings = _encode_in_batches(model, table_markdowns, "text")
     return text_embeddings, image_embeddings, table_embeddings
 
 def store_in_chromadb(session_id: str, text_chunks, text_embeddings, images, image_embeddings, tables, table_embeddings):
-    client = chromadb.PersistentClient(path="./chroma_db")
+    client = chromadb.PersistentClient(path=DB_PATH)
     
     collection = client.get_or_create_collection(name=session_id)
     
-    image_dir = "/tmp/extracted_images"
+    image_dir = os.path.join(IMAGE_DIR, session_id)
     os.makedirs(image_dir, exist_ok=True)
 
     ids, embeddings_list, documents, metadatas = [], [], [], []
     
-    for i, chunk in enumerate(text_chunks):
+    for i, (chunk, page_num, start) in enumerate(text_chunks):
         ids.append(f"text_chunk_{i}")
         embeddings_list.append(text_embeddings[i].tolist())
         documents.append(chunk)
-        metadatas.append({'type': 'text'})
+        # 'chunk' is the position in reading order, so text_chunk_{chunk - 1} and text_chunk_{chunk + 1} are its neighbours.
+        metadatas.append({'type': 'text', 'page': page_num, 'start': start, 'end': start + len(chunk), 'chunk': i})
 
+    # PNG encoding runs on the ingestion lane's threads rather than one image at a time.
+    save_jobs = []
     for i, (image, page_num) in enumerate(images):
+        image_id = f"image_{i}"
+        image_path = os.path.join(image_dir, f"{image_id}.png")
+        
+        # Ensure image is valid before saving
+        if image.width > 0 and image.height > 0:
+            save_jobs.append((i, image_id, image_path, page_num, scheduler.ingest_executor.submit(image.save, image_path, 'PNG')))
+
+    for i, image_id, image_path, page_num, save_job in save_jobs:
         try:
-            image_id = f"image_{i}"
-            image_path = os.path.join(image_dir, f"{image_id}.png")
-            
-            # Ensure image is valid before saving
-            if image.width > 0 and image.height > 0:
-                image.save(image_path, 'PNG')
-                ids.append(image_id)
-                if image_embeddings.size > 0:
-                    embeddings_list.append(image_embeddings[i].tolist())
-                documents.append(image_path)
-                metadatas.append({'type': 'image', 'page': page_num})
+            save_job.result()
+            ids.append(image_id)
+            if image_embeddings.size > 0:
+                embeddings_list.append(image_embeddings[i].tolist())
+            documents.append(image_path)
+            metadatas.append({'type': 'image', 'page': page_num})
         except Exception as e:
             # If a single image fails, log the error and continue
             print(f"WARNING: Skipping a problematic image on page {page_num}. Error: {e}")
@@ -84,18 +128,45 @@ def store_in_chromadb(session_id: str, text_chunks, text_embeddings, images, ima
 
     if ids:
         collection.add(ids=ids, embeddings=embeddings_list, documents=documents, metadatas=metadatas)
+
+    # Image documents are file paths, so only text and tables go into the lexical index.
+    lexical_ids = [id_ for id_, meta in zip(ids, metadatas) if meta['type'] != 'image']
+    lexical_docs = [doc for doc, meta in zip(documents, metadatas) if meta['type'] != 'image']
+    lexical_pages = [meta['page'] for meta in metadatas if meta['type'] != 'image']
+    lexical_index.build_and_save(session_id, lexical_ids, lexical_docs, lexical_pages)
     
     return collection.count()
 
-def load_query_models():
-    global embedding_model, collection, groq_client
+def ingest_document(session_id: str, pdf_path: str):
+    pages, images, tables = extract_content_from_pdf(pdf_path)
+
+    text_chunks = chunk_pages(pages)
+
+    print("Generating embeddings...")
+    text_emb, img_emb, tbl_emb = generate_embeddings(text_chunks, images, tables, embedding_model)
+
+    print("Storing in ChromaDB...")
+    return store_in_chromadb(session_id, text_chunks, text_emb, images, img_emb, tables, tbl_emb)
+
+def configure_torch_threads(num_threads: int):
+    # Each process gets its own share of the cores so N workers don't oversubscribe the CPU.
+    torch.set_num_threads(max(1, num_threads))
+    print(f"Torch intra-op threads set to {torch.get_num_threads()} (pid {os.getpid()}).")
+
+def load_embedding_model():
+    global embedding_model
     if embedding_model is None:
         print("Loading embedding model...")
-        embedding_model = SentenceTransformer('clip-ViT-B-32') 
+        embedding_model = SentenceTransformer(EMBEDDING_MODEL)
+        embedding_model.eval()
+
+def load_query_models():
+    global embedding_model, collection, groq_client
+    load_embedding_model()
             
     if groq_client is None:
         print("Initializing Groq client...")
-        groq_client = Groq(api_key=os.environ.get("GROQ_API_KEY"))
+        groq_client = llm_client.create_client()
     print("All query models and clients are loaded.")
 
 def analyze_image_with_groq(image_path: str):
@@ -105,17 +176,57 @@ def analyze_image_with_groq(image_path: str):
         image_url = f"data:image/png;base64,{base64_image}"
         prompt = "Describe this image in detail. If it's a diagram, explain its components, relationships, and the process it illustrates."
         
-        completion = groq_client.chat.completions.create(
+        completion = groq_client.complete(
+            timeout=VLM_TIMEOUT_SECONDS,
+            max_retries=VLM_MAX_RETRIES,
+            deadline_seconds=VLM_DEADLINE_SECONDS,
             model="meta-llama/llama-4-maverick-17b-128e-instruct",
             messages=[{"role": "user", "content": [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": image_url}}]}]
         )
-        return completion.choices[0].message.content if completion.choices else "VLM analysis failed."
+        return completion.choices[0].message.content if completion.choices else None
     except Exception as e:
-        return f"Error during Groq vision call: {e}"
+        print(f"Error during Groq vision call: {e}")
+        return None
+
+def describe_image(session_collection, image_id: str, image_path: str, metadata: dict):
+    # Descriptions are cached on the image's metadata, so each image goes to the VLM once per session.
+    if metadata.get('description'):
+        return metadata['description']
+    print(f"  > Analyzing image: {image_path}...")
+    desc = analyze_image_with_groq(image_path)
+    if desc is None:
+        return "VLM analysis failed."
+    session_collection.update(ids=[image_id], metadatas=[{**metadata, 'description': desc}])
+    return desc
+
+def retrieve_context(session_collection, session_id: str, query: str, pages=None):
+    # Fuses the CLIP vector ranking with a BM25 ranking, which catches exact terms CLIP misses.
+    where = {'page': {'$in': pages}} if pages else None
+    with scheduler.query_lane():
+        query_embedding = embedding_model.encode([query]).tolist()
+        results = session_collection.query(query_embeddings=query_embedding, n_results=RETRIEVAL_CANDIDATES, where=where)
 
-def process_query_and_generate(query: str, session_id: str):
+    found = {}
+    vector_ids = results['ids'][0] if results.get('ids') else []
+    for i, id_ in enumerate(vector_ids):
+        found[id_] = (id_, results['documents'][0][i], results['metadatas'][0][i])
+
+    index = lexical_index.load(session_id)
+    lexical_ids = [id_ for id_, _ in index.search(query, RETRIEVAL_CANDIDATES, pages)] if index else []
+
+    fused_ids = lexical_index.reciprocal_rank_fusion([vector_ids, lexical_ids])[:RETRIEVAL_TOP_K]
+
+    missing = [id_ for id_ in fused_ids if id_ not in found]
+    if missing:
+        extra = session_collection.get(ids=missing, include=['documents', 'metadatas'])
+        for i, id_ in enumerate(extra['ids']):
+            found[id_] = (id_, extra['documents'][i], extra['metadatas'][i])
+
+    return [found[id_] for id_ in fused_ids if id_ in found]
+
+def process_query_and_generate(query: str, session_id: str, pages=None):
     try:
-        client = chromadb.PersistentClient(path="./chroma_db")
+        client = chromadb.PersistentClient(path=DB_PATH)
         session_collection = client.get_collection(name=session_id)
     except Exception as e:
         yield f"Error: Could not find a database for the provided session. Please upload a document first. Details: {e}"
@@ -125,23 +236,18 @@ def process_query_and_generate(query: str, session_id: str):
         yield "Error: Models not loaded correctly. Please check server startup logs."
         return
 
-    query_embedding = embedding_model.encode([query]).tolist()
-    
-    results = session_collection.query(query_embeddings=query_embedding, n_results=10)
+    retrieved = retrieve_context(session_collection, session_id, query, pages)
     
     context_parts = []
-    if 'ids' in results and results['ids'][0]:
-        for i in range(len(results['ids'][0])):
-            metadata, document = results['metadatas'][0][i], results['documents'][0][i]
-            if metadata['type'] == 'image':
-                print(f"  > Analyzing image: {document}...")
-                desc = analyze_image_with_groq(document)
-                context_parts.append(f"Source: Image Description\nContent: {desc}")
-            elif metadata['type'] == 'table':
-                table = html.unescape(document).replace('<br>', '\n')
-                context_parts.append(f"Source: Table\nContent:\n{table}")
-            else:
-                context_parts.append(f"Source: Text Chunk\nContent: {document}")
+    for item_id, document, metadata in retrieved:
+        if metadata['type'] == 'image':
+            desc = describe_image(session_collection, item_id, document, metadata)
+            context_parts.append(f"Source: Image Description\nContent: {desc}")
+        elif metadata['type'] == 'table':
+            table = html.unescape(document).replace('<br>', '\n')
+            context_parts.append(f"Source: Table\nContent:\n{table}")
+        else:
+            context_parts.append(f"Source: Text Chunk\nContent: {document}")
     
     formatted_context = "\n---\n".join(context_parts)
     
@@ -167,16 +273,19 @@ def process_query_and_generate(query: str, session_id: str):
     user_prompt = f"CONTEXT:\n---\n{formatted_context}\n---\n\nQUESTION:\n{query}"
     
     try:
-        stream = groq_client.chat.completions.create(
+        stream = groq_client.stream(
             messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
             model="llama3-70b-8192",
             temperature=0.5,
             max_tokens=1024,
             top_p=1,
-            stream=True,
         )
         for chunk in stream:
             if chunk.choices[0].delta.content:
                 yield chunk.choices[0].delta.content
+    except groq.RateLimitError:
+        yield "The language model is receiving too many requests right now. Please try again in a moment."
+    except (groq.APITimeoutError, llm_client.CallDeadlineExceeded):
+        yield "The language model took too long to respond. Please try again."
     except Exception as e:
         yield f"Error calling Groq API: {e}"
\ No newline at end of file
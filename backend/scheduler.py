@@ -0,0 +1,101 @@
+import os
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Ingestion lane: background work that should never slow down interactive queries.
+INGEST_THREADS = int(os.environ.get("INGEST_THREADS", "2"))
+INGEST_TORCH_THREADS = int(os.environ.get("INGEST_TORCH_THREADS", "0"))  # 0 = share the cores evenly
+INGEST_NICE = int(os.environ.get("INGEST_NICE", "10"))
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "0"))  # 0 = size batches from available memory
+INGEST_MEMORY_FRACTION = float(os.environ.get("INGEST_MEMORY_FRACTION", "0.25"))
+INGEST_MAX_YIELD_SECONDS = float(os.environ.get("INGEST_MAX_YIELD_SECONDS", "2"))
+
+# Query lane: interactive requests.
+QUERY_CONCURRENCY = int(os.environ.get("QUERY_CONCURRENCY", "4"))
+
+MIN_BATCH_SIZE = 1
+MAX_BATCH_SIZE = 64
+# Rough peak memory per item while CLIP encodes it (input tensor plus activations).
+DEFAULT_AVAILABLE_MEMORY_BYTES = 1024 * 1024 * 1024
+BYTES_PER_ITEM = {"text": 2 * 1024 * 1024, "image": 16 * 1024 * 1024}
+
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_THREADS, thread_name_prefix="ingest")
+
+_query_slots = threading.BoundedSemaphore(QUERY_CONCURRENCY)
+_active_queries = 0
+_idle = threading.Condition()
+
+
+@contextmanager
+def query_lane():
+    # Marks a query as in progress so ingestion in this process backs off until it finishes.
+    global _active_queries
+    with _query_slots:
+        with _idle:
+            _active_queries += 1
+        try:
+            yield
+        finally:
+            with _idle:
+                _active_queries -= 1
+                if _active_queries == 0:
+                    _idle.notify_all()
+
+
+def yield_to_queries():
+    # Called by ingestion between units of work. Waits for running queries, but never
+    # for longer than INGEST_MAX_YIELD_SECONDS so a steady query load can't starve ingestion.
+    with _idle:
+        _idle.wait_for(lambda: _active_queries == 0, timeout=INGEST_MAX_YIELD_SECONDS)
+
+
+def _read_int(path: str):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None  # cgroup v2 writes "max" when there is no limit
+
+
+def _cgroup_available_bytes():
+    # Inside a container the limit that matters is the cgroup's, not the host's MemAvailable.
+    for limit_path, usage_path in (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes"),
+    ):
+        limit = _read_int(limit_path)
+        # cgroup v1 reports "no limit" as a huge number close to 2**63.
+        if limit is not None and limit < 2 ** 60:
+            return max(0, limit - (_read_int(usage_path) or 0))
+    return None
+
+
+def _host_available_bytes():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        # SC_AVPHYS_PAGES doesn't exist on macOS.
+        return DEFAULT_AVAILABLE_MEMORY_BYTES
+
+
+def _available_memory_bytes():
+    cgroup_available = _cgroup_available_bytes()
+    host_available = _host_available_bytes()
+    return host_available if cgroup_available is None else min(cgroup_available, host_available)
+
+
+def embedding_batch_size(kind: str):
+    if INGEST_BATCH_SIZE > 0:
+        return INGEST_BATCH_SIZE
+    budget = _available_memory_bytes() * INGEST_MEMORY_FRACTION
+    return max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, int(budget // BYTES_PER_ITEM[kind])))
+
@@ -0,0 +1,153 @@
+import os
+import io
+import json
+import time
+import uuid
+import shutil
+import tarfile
+import argparse
+import chromadb
+import chromadb.errors
+import numpy as np
+import lexical_index
+import config
+
+FORMAT_VERSION = 1
+READ_PAGE_SIZE = 1000
+
+# What get_collection raises for an unknown name differs between chromadb versions.
+MISSING_COLLECTION_ERRORS = tuple(
+    getattr(chromadb.errors, name) for name in ("NotFoundError", "InvalidCollectionException") if hasattr(chromadb.errors, name)
+) + (ValueError,)
+
+# Bundle layout (a gzipped tar):
+#   manifest.json       format version, source session, embedding model, item count
+#   records.json        ids, documents and metadatas (image descriptions live in the metadata)
+#   embeddings.npy      float32 matrix, one row per record
+#   lexical_index.json  the session's BM25 index
+#   images/<id>.png     extracted images; image documents point here in the bundle
+
+
+def _add_bytes(tar, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+
+class SessionNotFoundError(Exception):
+    pass
+
+
+def export_session(session_id: str, bundle_path: str):
+    client = chromadb.PersistentClient(path=config.DB_PATH)
+    try:
+        collection = client.get_collection(name=session_id)
+    except MISSING_COLLECTION_ERRORS as e:
+        raise SessionNotFoundError(f"No session named '{session_id}'.") from e
+
+    ids, documents, metadatas, embeddings = [], [], [], []
+    offset = 0
+    while True:
+        page = collection.get(include=["embeddings", "documents", "metadatas"], limit=READ_PAGE_SIZE, offset=offset)
+        if not page["ids"]:
+            break
+        ids.extend(page["ids"])
+        documents.extend(page["documents"])
+        metadatas.extend(page["metadatas"])
+        embeddings.append(np.asarray(page["embeddings"], dtype=np.float32))
+        offset += len(page["ids"])
+
+    with tarfile.open(bundle_path, "w:gz") as tar:
+        for i, (item_id, metadata) in enumerate(zip(ids, metadatas)):
+            if metadata["type"] == "image":
+                arcname = f"images/{item_id}.png"
+                tar.add(documents[i], arcname=arcname)
+                documents[i] = arcname
+
+        manifest = {
+            "format_version": FORMAT_VERSION,
+            "session_id": session_id,
+            "embedding_model": config.EMBEDDING_MODEL,
+            "item_count": len(ids),
+            "created_at": time.time(),
+        }
+        _add_bytes(tar, "manifest.json", json.dumps(manifest).encode())
+        _add_bytes(tar, "records.json", json.dumps({"ids": ids, "documents": documents, "metadatas": metadatas}).encode())
+
+        buffer = io.BytesIO()
+        np.save(buffer, np.concatenate(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32))
+        _add_bytes(tar, "embeddings.npy", buffer.getvalue())
+
+        index = lexical_index.load(session_id)
+        if index is not None:
+            _add_bytes(tar, "lexical_index.json", json.dumps(index.to_dict()).encode())
+
+    print(f"Exported {len(ids)} items from session {session_id} to {bundle_path}")
+    return len(ids)
+
+
+def import_bundle(bundle_path: str, session_id: str = None):
+    session_id = session_id or str(uuid.uuid4())
+    image_dir = os.path.join(config.IMAGE_DIR, session_id)
+
+    with tarfile.open(bundle_path, "r:gz") as tar:
+        manifest = json.load(tar.extractfile("manifest.json"))
+        if manifest["format_version"] > FORMAT_VERSION:
+            raise ValueError(f"Snapshot format version {manifest['format_version']} is newer than this server supports ({FORMAT_VERSION}).")
+        if manifest["embedding_model"] != config.EMBEDDING_MODEL:
+            raise ValueError(f"Snapshot was built with '{manifest['embedding_model']}', but this server uses '{config.EMBEDDING_MODEL}'.")
+
+        records = json.load(tar.extractfile("records.json"))
+        embeddings = np.load(io.BytesIO(tar.extractfile("embeddings.npy").read()))
+
+        # Creating the collection first means an existing session id fails before any of its files are touched.
+        client = chromadb.PersistentClient(path=config.DB_PATH)
+        collection = client.create_collection(name=session_id)
+        try:
+            os.makedirs(image_dir, exist_ok=True)
+            documents = records["documents"]
+            for i, metadata in enumerate(records["metadatas"]):
+                if metadata["type"] == "image":
+                    image_path = os.path.join(image_dir, os.path.basename(documents[i]))
+                    with open(image_path, "wb") as f:
+                        f.write(tar.extractfile(documents[i]).read())
+                    documents[i] = image_path
+
+            if "lexical_index.json" in tar.getnames():
+                index = lexical_index.BM25Index.from_dict(json.load(tar.extractfile("lexical_index.json")))
+                lexical_index.save(session_id, index)
+
+            ids, metadatas = records["ids"], records["metadatas"]
+            batch_size = client.get_max_batch_size()
+            for start in range(0, len(ids), batch_size):
+                end = start + batch_size
+                collection.add(ids=ids[start:end], embeddings=embeddings[start:end], documents=documents[start:end], metadatas=metadatas[start:end])
+        except BaseException:
+            # Never leave a half-imported session behind.
+            client.delete_collection(name=session_id)
+            shutil.rmtree(image_dir, ignore_errors=True)
+            lexical_index.delete(session_id)
+            raise
+
+    print(f"Imported {len(ids)} items from {bundle_path} into session {session_id}")
+    return session_id, collection.count()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or import a session as a snapshot bundle.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Write a session to a bundle file.")
+    export_parser.add_argument("session_id")
+    export_parser.add_argument("bundle_path")
+
+    import_parser = subparsers.add_parser("import", help="Load a bundle file into the local store.")
+    import_parser.add_argument("bundle_path")
+    import_parser.add_argument("--session-id", help="Session id to import into (a new one is generated by default).")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export_session(args.session_id, args.bundle_path)
+    else:
+        import_bundle(args.bundle_path, args.session_id)
@@ -0,0 +1,194 @@
+import os
+import hashlib
+import tempfile
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+    from python_multipart.exceptions import MultipartParseError
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+    from multipart.exceptions import MultipartParseError
+
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "/tmp/uploads")
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "100"))
+MAX_UPLOAD_BYTES = MAX_UPLOAD_MB * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Allowance for the multipart boundaries and headers around the file itself.
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+TOO_LARGE_DETAIL = f"File too large. The maximum upload size is {MAX_UPLOAD_MB} MB."
+
+# Upload endpoints read the request stream themselves, so they describe their body for /docs here.
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"],
+                }
+            }
+        },
+    }
+}
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+class UploadSizeLimitMiddleware:
+    # Plain ASGI middleware: it counts body bytes as they arrive, so an oversized upload is cut off
+    # with a 413 mid-stream whether or not the client sent a Content-Length.
+    def __init__(self, app, max_body_bytes: int = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_body_bytes:
+            await JSONResponse(status_code=413, content={"detail": TOO_LARGE_DETAIL})(scope, receive, send)
+            return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_bytes:
+                    raise _BodyTooLarge()
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except _BodyTooLarge:
+            if not response_started:
+                await JSONResponse(status_code=413, content={"detail": TOO_LARGE_DETAIL})(scope, receive, send)
+
+
+class SpooledUpload:
+    # Receives the multipart parser's callbacks and writes the part named "file" straight to disk.
+    def __init__(self, path: str, required_content_type: str = None):
+        self.path = path
+        self.required_content_type = required_content_type
+        self.filename = None
+        self.content_type = None
+        self.size = 0
+        self.found = False
+        self._digest = hashlib.sha256()
+        self._out = open(path, "wb")
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._in_file = False
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        }
+
+    def close(self):
+        self._out.close()
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field, self._header_value = b"", b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._in_file = options.get(b"name") == b"file" and not self.found
+        if not self._in_file:
+            return
+        self.found = True
+        self.filename = options.get(b"filename", b"").decode("utf-8", "replace")
+        self.content_type = self._headers.get(b"content-type", b"").decode("latin-1")
+        # The part headers arrive before the file data, so a wrong type is rejected before anything is written.
+        if self.required_content_type and self.content_type != self.required_content_type:
+            raise HTTPException(status_code=400, detail="Invalid file type. Please upload a PDF.")
+
+    def _on_part_data(self, data, start, end):
+        if not self._in_file:
+            return
+        chunk = data[start:end]
+        self.size += len(chunk)
+        if self.size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=TOO_LARGE_DETAIL)
+        self._digest.update(chunk)
+        self._out.write(chunk)
+
+    def _on_part_end(self):
+        self._in_file = False
+
+
+async def spool_upload(request: Request, required_content_type: str = None):
+    # Parses the multipart body straight from the request stream, so the file is written to disk
+    # exactly once. Parsing, hashing and writing run in the threadpool to keep the event loop free.
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload with a 'file' field.")
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".upload", dir=UPLOAD_DIR)
+    os.close(fd)
+    upload = SpooledUpload(path, required_content_type)
+    parser = MultipartParser(boundary, upload.callbacks())
+
+    try:
+        buffer = bytearray()
+        async for chunk in request.stream():
+            buffer += chunk
+            if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                await run_in_threadpool(parser.write, bytes(buffer))
+                buffer.clear()
+        await run_in_threadpool(parser.write, bytes(buffer))
+        parser.finalize()
+        upload.close()
+        if not upload.found:
+            raise HTTPException(status_code=400, detail="No file was uploaded. Send it in a 'file' field.")
+    except MultipartParseError as e:
+        upload.close()
+        os.remove(path)
+        raise HTTPException(status_code=400, detail=f"Malformed multipart upload: {e}")
+    except BaseException:
+        upload.close()
+        os.remove(path)
+        raise
+
+    return upload